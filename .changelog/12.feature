@@ -0,0 +1 @@
+`%%filprofile` cells now run like normal Jupyter cells: variables assigned in a profiled cell are still available in later cells, and so keep using memory, where previously they were freed when the cell finished.
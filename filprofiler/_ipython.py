@@ -4,7 +4,6 @@ a Jupyter notebook.
 """
 
 from pathlib import Path
-from textwrap import indent
 from contextlib import contextmanager
 
 from IPython.core.magic import Magics, magics_class, cell_magic
@@ -13,21 +12,6 @@ from IPython.display import IFrame, display
 from ._tracer import start_tracing, stop_tracing
 
 
-HOPEFULLY_UNIQUE_VAR = "__arghbldsada__"
-
-# We use a variable that is unlikely to conflict with user code.
-# We also:
-#
-# 1. Make sure line numbers line up with original code (first line is a magic,
-#    so we can put stuff there!)
-# 2. Make sure user code runs in a function, so top-level lines get recorded.
-TEMPLATE = """\
-def __magic_run_with_fil():
-{}
-with {}(): __magic_run_with_fil()
-"""
-
-
 @magics_class
 class FilMagics(Magics):
     """Magics for memory profiling."""
@@ -35,23 +19,48 @@ class FilMagics(Magics):
     @cell_magic
     def filprofile(self, line, cell):
         """Memory profile the code in the cell."""
-        # Inject run_with_profile:
-
-        self.shell.push({HOPEFULLY_UNIQUE_VAR: run_with_profile})
-
-        # Run the code.
+        # We compile the cell ourselves and only start tracing right before
+        # running it, so the cell's code is the top-level frame of the memory
+        # profile flamegraph, rather than a whole pile of irrelevant IPython
+        # code, or a wrapper function.
         #
-        # We use a template that does the Fil setup inside the cell, rather
-        # than here, so as to keep a whole pile of irrelevant IPython code
-        # appearing as frames at the top of the memory profile flamegraph.
+        # The first line of the cell is the magic, so we prepend an empty line
+        # to make sure line numbers line up with the original code, plus one
+        # for each leading blank line IPython's cleanup transforms strip.
         #
-        # Empirically inconsistent indents are just fine as far as Python is
-        # concerned(?!), so we don't need to do anything special for code that
-        # isn't 4-space indented.
-        self.shell.run_cell(TEMPLATE.format(indent(cell, "    "), HOPEFULLY_UNIQUE_VAR))
+        # Like run_cell(), errors in the cell are shown rather than propagated.
+        filename = None
+        try:
+            transformed = self.shell.transform_cell(cell)
+            stripped = _leading_blank_lines(cell) - _leading_blank_lines(transformed)
+            source = "\n" * (1 + stripped) + transformed
+            filename = self.shell.compile.cache(source, self.shell.execution_count)
+            # Parse separately, as run_cell() does, so syntax errors get the
+            # same messages they would in a normal cell:
+            tree = self.shell.compile.ast_parse(source, filename)
+            code = self.shell.compile(tree, filename, "exec")
+        except (OverflowError, SyntaxError, ValueError, TypeError, MemoryError):
+            self.shell.showsyntaxerror(filename)
+            return
+
+        # The cell runs in the user namespace, same as a normal cell, so names
+        # it assigns outlive it:
+        try:
+            with run_with_profile():
+                exec(code, self.shell.user_global_ns, self.shell.user_ns)
+        except Exception:
+            # Skip this method's frame in the traceback:
+            self.shell.showtraceback(tb_offset=1)
+
 
-        # Uninject run_with_profile:
-        self.shell.drop_by_id({HOPEFULLY_UNIQUE_VAR: run_with_profile})
+def _leading_blank_lines(code: str) -> int:
+    """Return how many lines at the start of the code are whitespace-only."""
+    count = 0
+    for line in code.splitlines():
+        if line and not line.isspace():
+            break
+        count += 1
+    return count
 
 
 @contextmanager
@@ -3,6 +3,10 @@
 import os
 from glob import glob
 from pathlib import Path
+from typing import Callable, Dict, Optional, Pattern
+
+# Matches any part of a callstack path passed to compile_path():
+ANY = object()
 
 
 def get_allocations(
@@ -22,13 +26,15 @@ def get_allocations(
     result = {}
     with open(glob(str(output_directory / "*" / prof_file))[0]) as f:
         for line in f:
-            *calls, size_kb = line.split(" ")
-            calls = " ".join(calls)
+            calls, size_kb = line.rsplit(" ", 1)
             size_kb = int(int(size_kb) / 1024)
-            path = []
             if calls == "[No Python stack]":
                 result[calls] = size_kb
                 continue
+            # Only bother parsing callstacks we're going to return:
+            if size_kb <= 900:
+                continue
+            path = []
             for call in calls.split(";"):
                 if call.startswith("TB@@"):
                     continue
@@ -39,16 +45,58 @@ def get_allocations(
                 file_name, line = part1.split(":")
                 line = int(line)
                 path.append((file_name, func_name, line))
-            if size_kb > 900:
-                result[tuple(path)] = size_kb
+            result[tuple(path)] = size_kb
     return result
 
 
-def as_mb(*args):
-    """Convert last argument from kilobyte to megabyte."""
-    return args[-1] / 1024
+def as_mb(size_kb):
+    """Convert a size from kilobyte to megabyte."""
+    return size_kb / 1024
 
 
 def big(length):
     """Return True for large values."""
     return length > 10000
+
+
+def _compile_part(part) -> Optional[Callable[[object], bool]]:
+    """Return a check for one part of a path, or None if anything matches."""
+    if part is ANY:
+        return None
+    if isinstance(part, Pattern):
+        return lambda value: isinstance(value, str) and part.search(value) is not None
+    return lambda value: value == part
+
+
+def compile_path(
+    path, predicate=big, convert=as_mb
+) -> Callable[[Dict], Optional[float]]:
+    """
+    Compile a callstack pattern into a function that finds the size of the
+    matching allocation in the result of get_allocations().
+
+    The path is a tuple of (filename, function name, line) tuples; each of those
+    parts can be a value, a compiled regex, or ANY. The returned function
+    returns convert(size) for the first allocation whose callstack matches and
+    whose size passes the predicate, or None if there isn't one.
+    """
+    length = len(path)
+    checks = []
+    for i, call in enumerate(path):
+        for j, part in enumerate(call):
+            check = _compile_part(part)
+            if check is not None:
+                checks.append((i, j, check))
+
+    def find(allocations: Dict) -> Optional[float]:
+        for callstack, size in allocations.items():
+            if (
+                isinstance(callstack, tuple)
+                and len(callstack) == length
+                and predicate(size)
+                and all(check(callstack[i][j]) for (i, j, check) in checks)
+            ):
+                return convert(size)
+        return None
+
+    return find
@@ -1,7 +1,7 @@
 """Trace code, so that libpymemprofile_api know's where we are."""
 
 import atexit
-from ctypes import PyDLL
+from ctypes import PyDLL, c_size_t, c_void_p
 from datetime import datetime
 import os
 import sys
@@ -14,6 +14,10 @@ from ._report import render_report
 
 preload = PyDLL(library_path("_filpreload"))
 preload.fil_initialize_from_python()
+# Used by tests to check whether an allocation is tracked. Declaring the
+# signature up front means the result isn't truncated to a C int:
+preload.pymemprofile_get_allocation_size.argtypes = [c_void_p]
+preload.pymemprofile_get_allocation_size.restype = c_size_t
 
 
 def start_tracing(output_path: str):
@@ -4,14 +4,16 @@ use im::Vector as ImVector;
 use inferno::flamegraph;
 use itertools::Itertools;
 use libc;
+use rustc_hash::FxHashMap;
 use std::cell::RefCell;
-use std::collections;
 use std::collections::HashMap;
 use std::fs;
-use std::io::Write;
+use std::hash::{BuildHasherDefault, Hash, Hasher};
+use std::io::{BufWriter, Write};
 use std::path::Path;
 use std::path::PathBuf;
 use std::slice;
+use std::sync::atomic::{AtomicUsize, Ordering};
 use std::sync::Mutex;
 
 /// A function location provided by the C code. Matches struct in _filpreload.c.
@@ -95,11 +97,6 @@ impl Callstack {
         Callstack { calls: Vec::new() }
     }
 
-    /// Is this a Python call?
-    fn in_python(&self) -> bool {
-        !self.calls.is_empty()
-    }
-
     fn start_call(&mut self, parent_line_number: u16, callsite_id: CallSiteId) {
         if parent_line_number != 0 {
             if let Some(mut call) = self.calls.last_mut() {
@@ -147,52 +144,312 @@ impl Callstack {
     }
 }
 
-thread_local!(static THREAD_CALLSTACK: RefCell<Callstack> = RefCell::new(Callstack::new()));
-
 type CallstackId = u32;
 
-/// Maps Functions to integer identifiers used in CallStacks.
+/// Parent of the callstacks with just one call.
+const ROOT_CALLSTACK_ID: CallstackId = CallstackId::MAX;
+
+/// Identifies a non-empty callstack in the CallstackInterner trie: the
+/// parent's ID plus the final call. The hash is calculated once, when the
+/// key is created, so looking up the same key in multiple maps (e.g. the
+/// per-thread cache and then the shared interner) doesn't rehash it.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+struct CallstackKey {
+    parent: CallstackId,
+    callsite_id: CallSiteId,
+    precomputed_hash: u64,
+}
+
+/// Multiplier for CallstackKey hashing, 2**64 divided by the golden ratio.
+const HASH_MULTIPLIER: u64 = 0x9E37_79B9_7F4A_7C15;
+
+impl CallstackKey {
+    fn new(parent: CallstackId, callsite_id: CallSiteId) -> Self {
+        // Pack the whole key into two words and mix them with a couple of
+        // multiplies, rather than feeding each field through a Hasher. The top
+        // 16 bits of a user-space pointer are zero, so the line number goes
+        // there:
+        let function = callsite_id.function.function as usize as u64;
+        let callsite = function ^ ((callsite_id.line_number as u64) << 48);
+        let mixed = ((parent as u64).wrapping_mul(HASH_MULTIPLIER) ^ callsite)
+            .rotate_left(31)
+            .wrapping_mul(HASH_MULTIPLIER);
+        CallstackKey {
+            parent,
+            callsite_id,
+            // The multiply leaves the low bits, which pick the hash table
+            // bucket, poorly mixed; fold the high bits back down:
+            precomputed_hash: mixed ^ (mixed >> 32),
+        }
+    }
+}
+
+impl Hash for CallstackKey {
+    fn hash<H: Hasher>(&self, state: &mut H) {
+        state.write_u64(self.precomputed_hash);
+    }
+}
+
+/// Hasher for keys that are already hashed, e.g. CallstackKey.
+#[derive(Default)]
+struct PrecomputedHasher {
+    hash: u64,
+}
+
+impl Hasher for PrecomputedHasher {
+    fn finish(&self) -> u64 {
+        self.hash
+    }
+
+    fn write(&mut self, _bytes: &[u8]) {
+        unreachable!("PrecomputedHasher only supports write_u64()");
+    }
+
+    fn write_u64(&mut self, hash: u64) {
+        self.hash = hash;
+    }
+}
+
+type CallstackKeyMap<V> = HashMap<CallstackKey, V, BuildHasherDefault<PrecomputedHasher>>;
+
+/// Maps Callstacks to integer identifiers used in CallStacks.
+///
+/// Callstacks are stored as a trie: a callstack's ID is looked up using its
+/// parent's ID plus its final call, so a callstack that extends a known one
+/// only needs one small lookup, rather than hashing every call in it.
 struct CallstackInterner {
-    max_id: CallstackId,
-    callstack_to_id: HashMap<Callstack, u32>,
+    // For each CallstackId, the parent's ID and the final call, or None for
+    // the empty callstack:
+    callstacks: Vec<Option<CallstackKey>>,
+    children: CallstackKeyMap<CallstackId>,
+    empty_id: Option<CallstackId>,
 }
 
 impl<'a> CallstackInterner {
     fn new() -> Self {
         CallstackInterner {
-            max_id: 0,
-            callstack_to_id: HashMap::default(),
+            callstacks: Vec::new(),
+            children: CallstackKeyMap::default(),
+            empty_id: None,
         }
     }
 
-    /// Add a (possibly) new Function, returning its ID.
-    fn get_or_insert_id<F: FnOnce() -> ()>(
+    /// Add a (possibly) new callstack consisting of the parent plus one more
+    /// call, returning its ID. Use ROOT_CALLSTACK_ID as the parent for a
+    /// callstack with a single call.
+    fn get_or_insert_child<F: FnOnce() -> ()>(
         &mut self,
-        callstack: &Callstack,
+        key: CallstackKey,
         call_on_new: F,
     ) -> CallstackId {
-        let max_id = &mut self.max_id;
-        if let Some(result) = self.callstack_to_id.get(callstack) {
-            *result
-        } else {
-            let new_id = *max_id;
-            *max_id += 1;
-            self.callstack_to_id.insert(callstack.clone(), new_id);
+        let callstacks = &mut self.callstacks;
+        *self.children.entry(key).or_insert_with(|| {
+            let new_id = callstacks.len() as CallstackId;
+            callstacks.push(Some(key));
             call_on_new();
             new_id
+        })
+    }
+
+    /// Add the (possibly) new empty callstack, returning its ID.
+    fn get_or_insert_empty<F: FnOnce() -> ()>(&mut self, call_on_new: F) -> CallstackId {
+        let callstacks = &mut self.callstacks;
+        *self.empty_id.get_or_insert_with(|| {
+            let new_id = callstacks.len() as CallstackId;
+            callstacks.push(None);
+            call_on_new();
+            new_id
+        })
+    }
+
+    /// Add a (possibly) new Callstack, returning its ID. Every prefix of the
+    /// callstack gets an ID too; call_on_new is called once for each new ID.
+    #[cfg(test)]
+    fn get_or_insert_id<F: FnMut() -> ()>(
+        &mut self,
+        callstack: &Callstack,
+        mut call_on_new: F,
+    ) -> CallstackId {
+        if callstack.calls.is_empty() {
+            return self.get_or_insert_empty(call_on_new);
+        }
+        let mut id = ROOT_CALLSTACK_ID;
+        for callsite_id in callstack.calls.iter() {
+            id = self.get_or_insert_child(CallstackKey::new(id, *callsite_id), &mut call_on_new);
         }
+        id
+    }
+
+    /// Is the given callstack a Python call?
+    fn in_python(&self, callstack_id: CallstackId) -> bool {
+        self.callstacks[callstack_id as usize].is_some()
     }
 
-    /// Get map from IDs to Functions.
-    fn get_reverse_map(&self) -> HashMap<CallstackId, &Callstack> {
-        let mut result = HashMap::default();
-        for (call_site, csid) in self.callstack_to_id.iter() {
-            result.insert(*csid, call_site);
+    /// Get the Callstack corresponding to an ID.
+    fn get_callstack(&self, mut callstack_id: CallstackId) -> Callstack {
+        let mut callstack = Callstack::new();
+        while let Some(key) = self.callstacks[callstack_id as usize] {
+            callstack.calls.push(key.callsite_id);
+            if key.parent == ROOT_CALLSTACK_ID {
+                break;
+            }
+            callstack_id = key.parent;
         }
-        result
+        callstack.calls.reverse();
+        callstack
     }
 }
 
+/// Per-thread cache of the CallstackInterner's trie. Most allocations come
+/// from callstacks we've seen before, so this lets us skip probing the shared
+/// CallstackInterner while holding the global lock.
+struct ThreadCallstackIds {
+    // The AllocationTracker generation the cached IDs are valid for:
+    generation: usize,
+    children: CallstackKeyMap<CallstackId>,
+    empty_id: Option<CallstackId>,
+}
+
+impl ThreadCallstackIds {
+    fn new() -> Self {
+        ThreadCallstackIds {
+            generation: 0,
+            children: CallstackKeyMap::default(),
+            empty_id: None,
+        }
+    }
+
+    /// Throw away all cached IDs, and start caching for a new generation.
+    fn reset(&mut self, generation: usize) {
+        self.generation = generation;
+        self.children.clear();
+        self.empty_id = None;
+    }
+}
+
+/// A thread's current Python callstack, plus a shadow stack of the
+/// CallstackIds for each of its prefixes. IDs are looked up when needed and
+/// then reused until the corresponding frame's line number changes, so
+/// repeated allocations from the same line don't have to look up the ID again.
+struct ThreadCallstack {
+    callstack: Callstack,
+    // ids[i] is the ID of the first i calls in the callstack, so there's
+    // always one more entry than there are calls:
+    ids: Vec<Option<CallstackId>>,
+    known_ids: ThreadCallstackIds,
+}
+
+impl ThreadCallstack {
+    fn new() -> Self {
+        ThreadCallstack {
+            callstack: Callstack::new(),
+            ids: vec![None],
+            known_ids: ThreadCallstackIds::new(),
+        }
+    }
+
+    fn start_call(&mut self, parent_line_number: u16, callsite_id: CallSiteId) {
+        if parent_line_number != 0 {
+            if let Some(call) = self.callstack.calls.last() {
+                if call.line_number != parent_line_number {
+                    *self.ids.last_mut().unwrap() = None;
+                }
+            }
+        }
+        self.callstack.start_call(parent_line_number, callsite_id);
+        self.ids.push(None);
+    }
+
+    fn finish_call(&mut self) {
+        self.callstack.finish_call();
+        self.ids.truncate(self.callstack.calls.len() + 1);
+    }
+
+    fn new_line_number(&mut self, line_number: u16) {
+        if let Some(call) = self.callstack.calls.last() {
+            if call.line_number != line_number {
+                self.callstack.new_line_number(line_number);
+                *self.ids.last_mut().unwrap() = None;
+            }
+        }
+    }
+
+    /// Return the (generation, ID) for the current callstack if it can be
+    /// found using only per-thread caches. The caller is responsible for
+    /// checking the generation matches the current AllocationTracker.
+    fn get_cached_id(&mut self) -> Option<(usize, CallstackId)> {
+        let known_ids = &self.known_ids;
+        if self.callstack.calls.is_empty() {
+            self.ids[0] = known_ids.empty_id;
+        }
+        resolve_ids(&mut self.ids, &self.callstack.calls, |key| {
+            known_ids.children.get(&key).copied()
+        })
+        .map(|callstack_id| (known_ids.generation, callstack_id))
+    }
+
+    /// Return the ID for the current callstack, adding it to the tracker's
+    /// CallstackInterner if necessary.
+    fn get_or_insert_id(&mut self, tracker: &mut AllocationTracker) -> CallstackId {
+        if tracker.generation != self.known_ids.generation {
+            self.known_ids.reset(tracker.generation);
+            for id in self.ids.iter_mut() {
+                *id = None;
+            }
+        }
+        let known_ids = &mut self.known_ids;
+        if self.callstack.calls.is_empty() {
+            let callstack_id = *known_ids
+                .empty_id
+                .get_or_insert_with(|| tracker.get_empty_callstack_id());
+            self.ids[0] = Some(callstack_id);
+            return callstack_id;
+        }
+        resolve_ids(&mut self.ids, &self.callstack.calls, |key| {
+            Some(
+                *known_ids
+                    .children
+                    .entry(key)
+                    .or_insert_with(|| tracker.get_child_callstack_id(key)),
+            )
+        })
+        .unwrap()
+    }
+}
+
+/// Fill in the shadow stack of IDs for the given calls, starting from the
+/// deepest prefix whose ID is already known. Returns the ID of the full
+/// callstack, or None if get_child() couldn't find one of the prefixes.
+fn resolve_ids<F: FnMut(CallstackKey) -> Option<CallstackId>>(
+    ids: &mut [Option<CallstackId>],
+    calls: &[CallSiteId],
+    mut get_child: F,
+) -> Option<CallstackId> {
+    let mut depth = calls.len();
+    while depth > 0 && ids[depth].is_none() {
+        depth -= 1;
+    }
+    if depth == calls.len() {
+        return ids[depth];
+    }
+    let mut parent = if depth == 0 {
+        ROOT_CALLSTACK_ID
+    } else {
+        ids[depth].unwrap()
+    };
+    for i in depth..calls.len() {
+        parent = get_child(CallstackKey::new(parent, calls[i]))?;
+        ids[i + 1] = Some(parent);
+    }
+    Some(parent)
+}
+
+thread_local!(static THREAD_CALLSTACK: RefCell<ThreadCallstack> = RefCell::new(ThreadCallstack::new()));
+
+/// Every AllocationTracker gets a unique generation, so per-thread caches can
+/// tell when their IDs are stale, e.g. after a reset().
+static NEXT_GENERATION: AtomicUsize = AtomicUsize::new(1);
+
 const MIB: usize = 1024 * 1024;
 const HIGH_32BIT: u32 = 1 << 31;
 
@@ -233,7 +490,8 @@ impl Allocation {
 
 /// The main data structure tracking everything.
 struct AllocationTracker {
-    // malloc()/calloc():
+    // malloc()/calloc(). This uses the default hasher since FxHash does
+    // badly with aligned addresses, where the low bits are always zero:
     current_allocations: HashMap<usize, Allocation>,
     // anonymous mmap(), i.e. not file backed:
     current_anon_mmaps: RangeMap<CallstackId>,
@@ -242,7 +500,11 @@ struct AllocationTracker {
     // memory:
     interner: CallstackInterner,
 
-    // Both malloc() and mmap():
+    // Both malloc() and mmap(). CallstackIds are dense indexes handed out by
+    // the interner, so updating a callstack's usage is a single indexed
+    // write, with no per-callstack allocation. These are persistent vectors
+    // rather than a flat Vec so that snapshotting a new peak is O(1) and
+    // only the chunks modified afterwards get copied:
     current_memory_usage: ImVector<usize>, // Map CallstackId -> total memory usage
     peak_memory_usage: ImVector<usize>,    // Map CallstackId -> total memory usage
     current_allocated_bytes: usize,
@@ -251,6 +513,8 @@ struct AllocationTracker {
     spare_memory: Vec<u8>,
     // Default directory to write out data lacking other info:
     default_path: String,
+    // Used to invalidate per-thread CallstackId caches:
+    generation: usize,
 }
 
 impl<'a> AllocationTracker {
@@ -265,6 +529,7 @@ impl<'a> AllocationTracker {
             peak_allocated_bytes: 0,
             spare_memory: Vec::with_capacity(16 * 1024 * 1024),
             default_path,
+            generation: NEXT_GENERATION.fetch_add(1, Ordering::Relaxed),
         }
     }
 
@@ -290,15 +555,27 @@ impl<'a> AllocationTracker {
         self.current_memory_usage[index] -= bytes;
     }
 
+    #[cfg(test)]
     fn get_callstack_id(&mut self, callstack: &Callstack) -> CallstackId {
         let current_memory_usage = &mut self.current_memory_usage;
         self.interner
             .get_or_insert_id(callstack, || current_memory_usage.push_back(0))
     }
 
+    fn get_child_callstack_id(&mut self, key: CallstackKey) -> CallstackId {
+        let current_memory_usage = &mut self.current_memory_usage;
+        self.interner
+            .get_or_insert_child(key, || current_memory_usage.push_back(0))
+    }
+
+    fn get_empty_callstack_id(&mut self) -> CallstackId {
+        let current_memory_usage = &mut self.current_memory_usage;
+        self.interner
+            .get_or_insert_empty(|| current_memory_usage.push_back(0))
+    }
+
     /// Add a new allocation based off the current callstack.
-    fn add_allocation(&mut self, address: usize, size: libc::size_t, callstack: &Callstack) {
-        let callstack_id = self.get_callstack_id(callstack);
+    fn add_allocation(&mut self, address: usize, size: libc::size_t, callstack_id: CallstackId) {
         let alloc = Allocation::new(callstack_id, size);
         let compressed_size = alloc.size();
         self.current_allocations.insert(address, alloc);
@@ -317,8 +594,7 @@ impl<'a> AllocationTracker {
     }
 
     /// Add a new anonymous mmap() based of the current callstack.
-    fn add_anon_mmap(&mut self, address: usize, size: libc::size_t, callstack: &Callstack) {
-        let callstack_id = self.get_callstack_id(callstack);
+    fn add_anon_mmap(&mut self, address: usize, size: libc::size_t, callstack_id: CallstackId) {
         self.current_anon_mmaps.add(address, size, callstack_id);
         self.add_memory_usage(callstack_id, size);
     }
@@ -342,7 +618,7 @@ impl<'a> AllocationTracker {
         // First, make sure peaks are correct:
         self.check_if_new_peak();
 
-        let mut by_call: collections::HashMap<CallstackId, usize> = collections::HashMap::new();
+        let mut by_call: FxHashMap<CallstackId, usize> = FxHashMap::default();
 
         if peak {
             for i in 0..self.peak_memory_usage.len() {
@@ -378,13 +654,12 @@ impl<'a> AllocationTracker {
         to_be_post_processed: bool,
     ) -> impl Iterator<Item = String> + '_ {
         let by_call = self.combine_callstacks(peak);
-        let id_to_callstack = self.interner.get_reverse_map();
+        let interner = &self.interner;
         by_call.map(move |(callstack_id, size)| {
             format!(
                 "{} {}",
-                id_to_callstack
-                    .get(&callstack_id)
-                    .unwrap()
+                interner
+                    .get_callstack(callstack_id)
                     .as_string(to_be_post_processed),
                 size,
             )
@@ -490,16 +765,10 @@ impl<'a> AllocationTracker {
             // only be _Python_ objects, Rust code shouldn't be tracked here since
             // we prevent reentrancy. We're not going to return to Python so
             // free()ing should be OK.
-            let id_to_callstack = self.interner.get_reverse_map();
             for (address, allocation) in self.current_allocations.iter() {
                 // Only clear large allocations that came out of a Python stack,
                 // to reduce chances of deallocating random important things.
-                if id_to_callstack
-                    .get(&allocation.callstack_id)
-                    .unwrap()
-                    .in_python()
-                    && allocation.size() > 300000
-                {
+                if self.interner.in_python(allocation.callstack_id) && allocation.size() > 300000 {
                     libc::free(*address as *mut ffi::c_void);
                 }
             }
@@ -507,6 +776,11 @@ impl<'a> AllocationTracker {
         eprintln!(
             "=fil-profile= And now, we'll dump out SVGs. Note that no HTML file will be written."
         );
+        // No need for a preallocated output buffer here: the reports are
+        // written via a BufWriter (see write_lines()), so it's a handful of
+        // large write()s rather than one per callstack, and the memory for the
+        // buffer comes out of what we just freed above. Formatting callstacks
+        // and rendering the SVGs with inferno allocate anyway.
         let default_path = self.default_path.clone();
         self.dump_to_flamegraph(
             &default_path,
@@ -557,15 +831,23 @@ pub fn add_allocation(address: usize, size: libc::size_t, line_number: u16, is_m
         allocations.oom_break_glass();
     }
 
-    let mut callstack: Callstack = THREAD_CALLSTACK.with(|cs| (*cs.borrow()).clone());
-    if line_number != 0 && !callstack.calls.is_empty() {
-        callstack.new_line_number(line_number);
-    }
+    // Try the per-thread caches before we take the lock:
+    let cached_id = THREAD_CALLSTACK.with(|tcs| {
+        let mut tcs = tcs.borrow_mut();
+        if line_number != 0 {
+            tcs.new_line_number(line_number);
+        }
+        tcs.get_cached_id()
+    });
     let mut allocations = ALLOCATIONS.lock().unwrap();
+    let callstack_id = match cached_id {
+        Some((generation, callstack_id)) if generation == allocations.generation => callstack_id,
+        _ => THREAD_CALLSTACK.with(|tcs| tcs.borrow_mut().get_or_insert_id(&mut allocations)),
+    };
     if is_mmap {
-        allocations.add_anon_mmap(address, size, &callstack);
+        allocations.add_anon_mmap(address, size, callstack_id);
     } else {
-        allocations.add_allocation(address, size, &callstack);
+        allocations.add_allocation(address, size, callstack_id);
     }
     if address == 0 {
         // Uh-oh, we're out of memory.
@@ -606,9 +888,13 @@ pub fn dump_peak_to_flamegraph(path: &str) {
     allocations.dump_peak_to_flamegraph(path);
 }
 
+/// Size of buffers used when writing out reports, so we don't do a syscall
+/// per line or per SVG element.
+const WRITE_BUFFER_SIZE: usize = 1024 * 1024;
+
 /// Write strings to disk, one line per string.
 fn write_lines<I: Iterator<Item = String>>(lines: I, path: &str) -> std::io::Result<()> {
-    let mut file = fs::File::create(path)?;
+    let mut file = BufWriter::with_capacity(WRITE_BUFFER_SIZE, fs::File::create(path)?);
     for line in lines {
         file.write_all(line.as_bytes())?;
         file.write_all(b"\n")?;
@@ -626,7 +912,7 @@ fn write_flamegraph(
     title: &str,
     to_be_post_processed: bool,
 ) -> std::io::Result<()> {
-    let mut file = std::fs::File::create(path)?;
+    let mut file = BufWriter::with_capacity(WRITE_BUFFER_SIZE, std::fs::File::create(path)?);
     let title = format!(
         "{}{} ({:.1} MiB)",
         title,
@@ -650,7 +936,9 @@ fn write_flamegraph(
     if to_be_post_processed {
         options.subtitle = Some("SUBTITLE-HERE".to_string());
     }
-    if let Err(e) = flamegraph::from_files(&mut options, &[PathBuf::from(lines_file_path)], &file) {
+    if let Err(e) =
+        flamegraph::from_files(&mut options, &[PathBuf::from(lines_file_path)], &mut file)
+    {
         Err(std::io::Error::new(
             std::io::ErrorKind::Other,
             format!("{}", e),
@@ -664,12 +952,11 @@ fn write_flamegraph(
 #[cfg(test)]
 mod tests {
     use super::{
-        Allocation, AllocationTracker, CallSiteId, Callstack, CallstackInterner, FunctionId,
-        FunctionLocation, HIGH_32BIT, MIB,
+        Allocation, AllocationTracker, CallSiteId, Callstack, CallstackInterner, CallstackKey,
+        FunctionId, FunctionLocation, ThreadCallstack, HIGH_32BIT, MIB, ROOT_CALLSTACK_ID,
     };
     use im;
     use proptest::prelude::*;
-    use std::collections;
 
     proptest! {
         // Allocation sizes smaller than 2 ** 31 are round-tripped.
@@ -697,8 +984,9 @@ mod tests {
         #[test]
         fn correct_allocation_size_tracked(size in (1 as usize)..(1<< 50)) {
             let mut tracker = AllocationTracker::new(".".to_string());
-            tracker.add_allocation(0, size, &Callstack::new());
-            tracker.add_anon_mmap(1, size * 2, &Callstack::new());
+            let id = tracker.get_callstack_id(&Callstack::new());
+            tracker.add_allocation(0, size, id);
+            tracker.add_anon_mmap(1, size * 2, id);
             // We don't track (large) allocations exactly right, but they should
             // be quite close:
             let ratio = ((size * 3) as f64) / (tracker.current_memory_usage[0] as f64);
@@ -722,7 +1010,8 @@ mod tests {
             for i in 0..allocated_sizes.len() {
                 let mut cs = Callstack::new();
                 cs.start_call(0, CallSiteId::new(FunctionId::new(i as *const FunctionLocation), 0));
-                tracker.add_allocation(i as usize,*allocated_sizes.get(i).unwrap(), &cs);
+                let cs_id = tracker.get_callstack_id(&cs);
+                tracker.add_allocation(i as usize,*allocated_sizes.get(i).unwrap(), cs_id);
                 expected_memory_usage.push_back(*allocated_sizes.get(i).unwrap());
             }
             let mut expected_sum = allocated_sizes.iter().sum();
@@ -753,7 +1042,8 @@ mod tests {
             for i in 0..allocated_sizes.len() {
                 let mut cs = Callstack::new();
                 cs.start_call(0, CallSiteId::new(FunctionId::new(i as *const FunctionLocation), 0));
-                tracker.add_anon_mmap(addresses[i] as usize, *allocated_sizes.get(i).unwrap(), &cs);
+                let cs_id = tracker.get_callstack_id(&cs);
+                tracker.add_anon_mmap(addresses[i] as usize, *allocated_sizes.get(i).unwrap(), cs_id);
                 expected_memory_usage.push_back(*allocated_sizes.get(i).unwrap());
             }
             let mut expected_sum = allocated_sizes.iter().sum();
@@ -854,11 +1144,139 @@ mod tests {
         assert_ne!(id1, id3);
         assert_ne!(id2, id3);
         assert_eq!(id3, id3b);
-        let mut expected = collections::HashMap::default();
-        expected.insert(id1, &cs1);
-        expected.insert(id2, &cs2);
-        expected.insert(id3, &cs3);
-        assert_eq!(interner.get_reverse_map(), expected);
+        assert_eq!(interner.get_callstack(id1), cs1);
+        assert_eq!(interner.get_callstack(id2), cs2);
+        assert_eq!(interner.get_callstack(id3), cs3);
+        assert!(interner.in_python(id1));
+        assert!(interner.in_python(id2));
+        assert!(!interner.in_python(id3));
+    }
+
+    #[test]
+    fn callstackinterner_shares_prefixes() {
+        let func1 = FunctionLocation::from_strings("a", "af");
+        let func2 = FunctionLocation::from_strings("b", "bf");
+        let func3 = FunctionLocation::from_strings("c", "cf");
+        let fid1 = FunctionId::new(&func1 as *const FunctionLocation);
+        let fid2 = FunctionId::new(&func2 as *const FunctionLocation);
+        let fid3 = FunctionId::new(&func3 as *const FunctionLocation);
+
+        let mut cs_ab = Callstack::new();
+        cs_ab.start_call(0, CallSiteId::new(fid1, 1));
+        cs_ab.start_call(0, CallSiteId::new(fid2, 2));
+        let mut cs_a = Callstack::new();
+        cs_a.start_call(0, CallSiteId::new(fid1, 1));
+        let mut cs_ac = cs_a.clone();
+        cs_ac.start_call(0, CallSiteId::new(fid3, 3));
+
+        let mut interner = CallstackInterner::new();
+        let mut new = 0;
+        // Both the callstack and its prefix get new IDs:
+        let ab_id = interner.get_or_insert_id(&cs_ab, || new += 1);
+        assert_eq!(new, 2);
+        // The prefix already exists:
+        let a_id = interner.get_or_insert_id(&cs_a, || new += 1);
+        assert_eq!(new, 2);
+        // Only one new call:
+        let ac_id = interner.get_or_insert_id(&cs_ac, || new += 1);
+        assert_eq!(new, 3);
+        assert_eq!(
+            interner.get_or_insert_child(CallstackKey::new(a_id, CallSiteId::new(fid2, 2)), || {
+                new += 1
+            }),
+            ab_id
+        );
+        assert_eq!(new, 3);
+
+        assert_eq!(interner.get_callstack(ab_id), cs_ab);
+        assert_eq!(interner.get_callstack(a_id), cs_a);
+        assert_eq!(interner.get_callstack(ac_id), cs_ac);
+    }
+
+    #[test]
+    fn callstackkey_hash_uses_all_fields() {
+        // Fixed addresses, so the result doesn't depend on ASLR; the
+        // FunctionLocations are never dereferenced:
+        let fid1 = FunctionId::new(0x7f12_3456_7000 as *const FunctionLocation);
+        let fid2 = FunctionId::new(0x7f12_3456_7020 as *const FunctionLocation);
+
+        let mut hashes = std::collections::HashSet::new();
+        let mut buckets = std::collections::HashSet::new();
+        for parent in [ROOT_CALLSTACK_ID, 0, 1].iter() {
+            for fid in [fid1, fid2].iter() {
+                for line in 1..=10 {
+                    let key = CallstackKey::new(*parent, CallSiteId::new(*fid, line));
+                    // Same inputs, same hash:
+                    assert_eq!(
+                        key.precomputed_hash,
+                        CallstackKey::new(*parent, CallSiteId::new(*fid, line)).precomputed_hash
+                    );
+                    hashes.insert(key.precomputed_hash);
+                    buckets.insert(key.precomputed_hash & 63);
+                }
+            }
+        }
+        // Changing any field changes the hash:
+        assert_eq!(hashes.len(), 60);
+        // And the low bits used to pick buckets are spread out about as well
+        // as random values would be (~39 of 64 buckets for 60 keys; these
+        // inputs hit 40):
+        assert!(buckets.len() >= 36);
+    }
+
+    #[test]
+    fn threadcallstack_caches_ids() {
+        let func1 = FunctionLocation::from_strings("a", "af");
+        let func2 = FunctionLocation::from_strings("b", "bf");
+        let fid1 = FunctionId::new(&func1 as *const FunctionLocation);
+        let fid2 = FunctionId::new(&func2 as *const FunctionLocation);
+
+        let mut tracker = AllocationTracker::new(".".to_string());
+        let mut tcs = ThreadCallstack::new();
+        assert_eq!(tcs.get_cached_id(), None);
+        let empty_id = tcs.get_or_insert_id(&mut tracker);
+        assert_eq!(tcs.get_cached_id(), Some((tracker.generation, empty_id)));
+
+        tcs.start_call(0, CallSiteId::new(fid1, 2));
+        assert_eq!(tcs.get_cached_id(), None);
+        let a2_id = tcs.get_or_insert_id(&mut tracker);
+        assert_eq!(a2_id, tracker.get_callstack_id(&tcs.callstack));
+        // Same line number, so still cached:
+        tcs.new_line_number(2);
+        assert_eq!(tcs.get_cached_id(), Some((tracker.generation, a2_id)));
+
+        // New line number means a new callstack:
+        tcs.new_line_number(3);
+        assert_eq!(tcs.get_cached_id(), None);
+        let a3_id = tcs.get_or_insert_id(&mut tracker);
+        assert_ne!(a2_id, a3_id);
+
+        // Finishing a call restores the parent's cached ID:
+        tcs.start_call(0, CallSiteId::new(fid2, 7));
+        let a3_b7_id = tcs.get_or_insert_id(&mut tracker);
+        assert_eq!(a3_b7_id, tracker.get_callstack_id(&tcs.callstack));
+        tcs.finish_call();
+        assert_eq!(tcs.get_cached_id(), Some((tracker.generation, a3_id)));
+
+        // Callstacks seen before are found in the per-thread cache:
+        tcs.new_line_number(2);
+        assert_eq!(tcs.get_cached_id(), Some((tracker.generation, a2_id)));
+        tcs.start_call(3, CallSiteId::new(fid2, 7));
+        assert_eq!(tcs.get_cached_id(), Some((tracker.generation, a3_b7_id)));
+        tcs.finish_call();
+        assert_eq!(tcs.callstack.calls, vec![CallSiteId::new(fid1, 3)]);
+        tcs.finish_call();
+        assert_eq!(tcs.get_cached_id(), Some((tracker.generation, empty_id)));
+
+        // A new tracker, e.g. after reset(), means IDs get looked up again:
+        let mut tracker2 = AllocationTracker::new(".".to_string());
+        assert_ne!(tracker.generation, tracker2.generation);
+        tcs.start_call(0, CallSiteId::new(fid2, 1));
+        let b1_id = tcs.get_or_insert_id(&mut tracker2);
+        assert_eq!(b1_id, 0);
+        assert_eq!(tcs.get_cached_id(), Some((tracker2.generation, b1_id)));
+        tcs.finish_call();
+        assert_eq!(tcs.get_cached_id(), None);
     }
 
     #[test]
@@ -874,7 +1292,8 @@ mod tests {
         let mut cs2 = Callstack::new();
         cs2.start_call(0, CallSiteId::new(fid3, 4));
 
-        tracker.add_allocation(1, 1000, &cs1);
+        let cs1_id = tracker.get_callstack_id(&cs1);
+        tracker.add_allocation(1, 1000, cs1_id);
         tracker.check_if_new_peak();
         // Peak should now match current allocations:
         assert_eq!(tracker.current_memory_usage, im::vector![1000]);
@@ -890,14 +1309,15 @@ mod tests {
         assert_eq!(tracker.peak_allocated_bytes, 1000);
 
         // Add allocation, still less than 1000:
-        tracker.add_allocation(3, 123, &cs1);
+        tracker.add_allocation(3, 123, cs1_id);
         assert_eq!(tracker.current_memory_usage, im::vector![123]);
         tracker.check_if_new_peak();
         assert_eq!(previous_peak, tracker.peak_memory_usage);
         assert_eq!(tracker.peak_allocated_bytes, 1000);
 
         // Add allocation that goes past previous peak
-        tracker.add_allocation(2, 2000, &cs2);
+        let cs2_id = tracker.get_callstack_id(&cs2);
+        tracker.add_allocation(2, 2000, cs2_id);
         tracker.check_if_new_peak();
         assert_eq!(tracker.current_memory_usage, im::vector![123, 2000]);
         assert_eq!(tracker.current_memory_usage, tracker.peak_memory_usage);
@@ -907,7 +1327,7 @@ mod tests {
         // Add anonymous mmap() that doesn't go past previous peak:
         tracker.free_allocation(2);
         assert_eq!(tracker.current_memory_usage, im::vector![123, 0]);
-        tracker.add_anon_mmap(50000, 1000, &cs2);
+        tracker.add_anon_mmap(50000, 1000, cs2_id);
         assert_eq!(tracker.current_memory_usage, im::vector![123, 1000]);
         tracker.check_if_new_peak();
         assert_eq!(tracker.current_allocated_bytes, 1123);
@@ -918,7 +1338,7 @@ mod tests {
         assert!(tracker.current_anon_mmaps.size() > 0);
 
         // Add anonymous mmap() that does go past previous peak:
-        tracker.add_anon_mmap(600000, 2000, &cs2);
+        tracker.add_anon_mmap(600000, 2000, cs2_id);
         assert_eq!(tracker.current_memory_usage, im::vector![123, 3000]);
         tracker.check_if_new_peak();
         assert_eq!(tracker.current_memory_usage, tracker.peak_memory_usage);
@@ -971,10 +1391,13 @@ mod tests {
         cs3.start_call(0, id1_different);
         cs3.start_call(0, id2);
 
-        tracker.add_allocation(1, 1000, &cs1);
-        tracker.add_allocation(2, 234, &cs2);
-        tracker.add_anon_mmap(3, 50000, &cs1);
-        tracker.add_allocation(4, 6000, &cs3);
+        let cs1_id = tracker.get_callstack_id(&cs1);
+        let cs2_id = tracker.get_callstack_id(&cs2);
+        let cs3_id = tracker.get_callstack_id(&cs3);
+        tracker.add_allocation(1, 1000, cs1_id);
+        tracker.add_allocation(2, 234, cs2_id);
+        tracker.add_anon_mmap(3, 50000, cs1_id);
+        tracker.add_allocation(4, 6000, cs3_id);
 
         let mut expected = vec![
             "a:1 (af);TB@@a:1@@TB;b:2 (bf);TB@@b:2@@TB 51000".to_string(),
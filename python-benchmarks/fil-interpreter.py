@@ -14,14 +14,16 @@ from pathlib import Path
 import pytest
 import numpy as np
 import numpy.core.numeric
-from pampy import _ as ANY, match
 from IPython.core.displaypub import CapturingDisplayPublisher
 from IPython.core.interactiveshell import InteractiveShell
 
 from filprofiler._tracer import preload, start_tracing, stop_tracing
-from filprofiler._testing import get_allocations, big, as_mb
+from filprofiler._testing import get_allocations, compile_path, ANY
 from pymalloc import pymalloc
 
+# Callstack entry for numpy.ones():
+_ONES = (numpy.core.numeric.__file__, "ones", ANY)
+
 
 def test_no_profiling():
     """Neither memory tracking nor Python profiling happen by default."""
@@ -42,26 +44,41 @@ def test_temporary_profiling(tmpdir):
     stop_tracing(tmpdir)
 
     # Allocations were tracked:
-    path = ((__file__, "f", 39), (numpy.core.numeric.__file__, "ones", ANY))
+    path = ((__file__, "f", 41), _ONES)
     allocations = get_allocations(tmpdir)
-    assert match(allocations, {path: big}, as_mb) == pytest.approx(32, 0.1)
+    assert compile_path(path)(allocations) == pytest.approx(32, 0.1)
 
     # Profiling stopped:
     test_no_profiling()
 
 
-def run_in_ipython_shell(code_cells):
-    """Run a list of strings in IPython.
+@pytest.fixture(scope="module")
+def ipython_shell():
+    """An IPython shell with the Fil extension loaded, shared between tests."""
+    InteractiveShell.clear_instance()
+    shell = InteractiveShell.instance(display_pub_class=CapturingDisplayPublisher)
+    shell.run_cell("%load_ext filprofiler")
+    yield shell
+    InteractiveShell.clear_instance()
+
+
+def _reset_shell(shell):
+    """Reset the shared shell, so a test doesn't see earlier tests' state."""
+    shell.reset(new_session=True)
+    shell.display_pub.clear_output()
+
+
+def run_in_ipython_shell(shell, code_cells):
+    """Run a list of strings in a freshly reset IPython shell.
 
     Returns parsed allocations.
     """
-    InteractiveShell.clear_instance()
-
-    shell = InteractiveShell.instance(display_pub_class=CapturingDisplayPublisher)
+    _reset_shell(shell)
     for code in code_cells:
         shell.run_cell(code)
-    InteractiveShell.clear_instance()
-    html = shell.display_pub.outputs[-1]["data"]["text/html"]
+    # Only this run's report, none left over from previous tests:
+    [output] = shell.display_pub.outputs
+    html = output["data"]["text/html"]
     assert "<iframe" in html
     [svg_path] = re.findall('src="([^"]*)"', html)
     assert svg_path.endswith("peak-memory.svg")
@@ -70,33 +87,33 @@ def run_in_ipython_shell(code_cells):
     return get_allocations(resultdir)
 
 
-def test_ipython_profiling(tmpdir):
+def test_ipython_profiling(ipython_shell, tmpdir):
     """Profiling can be run via IPython magic."""
     cwd = os.getcwd()
     os.chdir(tmpdir)
     allocations = run_in_ipython_shell(
+        ipython_shell,
         [
-            "%load_ext filprofiler",
             """\
 %%filprofile
 import numpy as np
 arr = np.ones((1024, 1024, 4), dtype=np.uint64)  # 32MB
 """,
-        ]
+        ],
     )
 
     # Allocations were tracked:
     path = (
-        (re.compile("<ipython-input-1-.*"), "__magic_run_with_fil", 3),
-        (numpy.core.numeric.__file__, "ones", ANY),
+        (re.compile("<ipython-input-1-.*"), "<module>", 3),
+        _ONES,
     )
-    assert match(allocations, {path: big}, as_mb) == pytest.approx(32, 0.1)
+    assert compile_path(path)(allocations) == pytest.approx(32, 0.1)
 
     # Profiling stopped:
     test_no_profiling()
 
 
-def test_ipython_exception_while_profiling(tmpdir):
+def test_ipython_exception_while_profiling(ipython_shell, tmpdir):
     """
     Profiling can be run via IPython magic, still profiles and shuts down
     correctly on an exception.
@@ -106,8 +123,8 @@ def test_ipython_exception_while_profiling(tmpdir):
     cwd = os.getcwd()
     os.chdir(tmpdir)
     allocations = run_in_ipython_shell(
+        ipython_shell,
         [
-            "%load_ext filprofiler",
             """\
 %%filprofile
 import numpy as np
@@ -115,21 +132,21 @@ arr = np.ones((1024, 1024, 2), dtype=np.uint64)  # 16MB
 raise RuntimeError("The test will log this, it's OK.")
 arr = np.ones((1024, 1024, 8), dtype=np.uint64)  # 64MB
 """,
-        ]
+        ],
     )
 
     # Allocations were tracked:
     path = (
-        (re.compile("<ipython-input-1-.*"), "__magic_run_with_fil", 3),
-        (numpy.core.numeric.__file__, "ones", ANY),
+        (re.compile("<ipython-input-1-.*"), "<module>", 3),
+        _ONES,
     )
-    assert match(allocations, {path: big}, as_mb) == pytest.approx(16, 0.1)
+    assert compile_path(path)(allocations) == pytest.approx(16, 0.1)
 
     # Profiling stopped:
     test_no_profiling()
 
 
-def test_ipython_non_standard_indent(tmpdir):
+def test_ipython_non_standard_indent(ipython_shell, tmpdir):
     """
     Profiling can be run via IPython magic, still profiles and shuts down
     correctly on an exception.
@@ -139,8 +156,8 @@ def test_ipython_non_standard_indent(tmpdir):
     cwd = os.getcwd()
     os.chdir(tmpdir)
     allocations = run_in_ipython_shell(
+        ipython_shell,
         [
-            "%load_ext filprofiler",
             """\
 %%filprofile
 import numpy as np
@@ -148,16 +165,65 @@ def f():  # indented with 5 spaces what
      arr = np.ones((1024, 1024, 2), dtype=np.uint64)  # 16MB
 f()
 """,
-        ]
+        ],
     )
 
     # Allocations were tracked:
     path = (
-        (re.compile("<ipython-input-1-.*"), "__magic_run_with_fil", 5),
+        (re.compile("<ipython-input-1-.*"), "<module>", 5),
         (re.compile("<ipython-input-1-.*"), "f", 4),
-        (numpy.core.numeric.__file__, "ones", ANY),
+        _ONES,
     )
-    assert match(allocations, {path: big}, as_mb) == pytest.approx(16, 0.1)
+    assert compile_path(path)(allocations) == pytest.approx(16, 0.1)
 
     # Profiling stopped:
     test_no_profiling()
+
+
+def test_ipython_leading_blank_lines(ipython_shell, tmpdir):
+    """
+    Line numbers still match the cell when it has blank lines after the magic,
+    which IPython strips before running the code.
+    """
+    cwd = os.getcwd()
+    os.chdir(tmpdir)
+    allocations = run_in_ipython_shell(
+        ipython_shell,
+        [
+            "%%filprofile\n"
+            "\n"
+            "    \n"  # whitespace-only lines are stripped too
+            "import numpy as np\n"
+            "arr = np.ones((1024, 1024, 4), dtype=np.uint64)  # 32MB\n",
+        ],
+    )
+
+    # Allocations were tracked:
+    path = (
+        (re.compile("<ipython-input-1-.*"), "<module>", 5),
+        _ONES,
+    )
+    assert compile_path(path)(allocations) == pytest.approx(32, 0.1)
+
+    # Profiling stopped:
+    test_no_profiling()
+
+
+def test_ipython_syntax_error(ipython_shell, capsys):
+    """
+    A syntax error in a profiled cell is reported the same way as in a normal
+    cell, without profiling anything.
+    """
+    _reset_shell(ipython_shell)
+    result = ipython_shell.run_cell("%%filprofile\nx = (1,\n")
+    assert result.error_in_exec is None
+
+    # Just the syntax error, no traceback through the magic:
+    output = capsys.readouterr().out
+    assert "SyntaxError" in output
+    assert "run_cell_magic" not in output
+
+    # No report was displayed, not even an earlier test's, and profiling isn't
+    # running:
+    assert ipython_shell.display_pub.outputs == []
+    test_no_profiling()